@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import deque
+
+# Rough cost of each request type, in tokens. pendingSend scans the whole ledger so it's by far the most expensive,
+# registerNode makes the node connect back to whoever sent it
+costs = {
+    "ping": 1,
+    "negotiate": 1,
+    "fetchNodes": 1,
+    "registerNode": 50,
+    "balance": 1,
+    "getPrevious": 1,
+    "cacheStats": 1,
+    "history": 2,
+    "blocks": 3,
+    "send": 2,
+    "receive": 3,
+    "open": 3,
+    "broadcast": 3,
+    "pendingSend": 500,
+}
+defaultCost = 2
+
+# Token bucket sizes (tokens per second, burst). That's 2 pendingSend scans a second per connection and 10 for the
+# whole node, while still leaving room for hundreds of sends a second. Peers share their own global bucket, so
+# wallets using up theirs can't stop blocks from being relayed between nodes
+connectionRate = 1000
+connectionBurst = 2000
+globalRate = 5000
+globalBurst = 10000
+peerRate = 5000
+peerBurst = 10000
+
+# Requests read from a connection but not processed yet. Once full we stop reading from that client
+queueSize = 64
+
+# Requests processed at once over all connections, and how many wallet requests may wait for a slot before
+# new ones are turned away as busy. Peers always wait.
+slots = 16
+maxWaiting = 256
+
+PEER = 0
+WALLET = 1
+
+
+def cost(requestType):
+    return costs.get(requestType, defaultCost)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Take cost tokens if there are enough, without waiting
+    def take(self, cost):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < cost:
+            return False
+
+        self.tokens -= cost
+        return True
+
+
+# Limits how many requests are processed at once. Free slots go to waiting peer requests before wallet requests
+class Scheduler:
+    def __init__(self, slots, maxWaiting):
+        self.free = slots
+        self.maxWaiting = maxWaiting
+        self.waiting = {PEER: deque(), WALLET: deque()}
+
+    # Wait for a slot. Returns False straight away if the wallet queue is already full
+    async def acquire(self, priority):
+        if self.free > 0 and not self.waiting[PEER] and not self.waiting[WALLET]:
+            self.free -= 1
+            return True
+
+        if priority == WALLET and len(self.waiting[WALLET]) >= self.maxWaiting:
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[priority].append(future)
+        try:
+            await future
+
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+
+            else:
+                self.waiting[priority].remove(future)
+
+            raise
+
+        return True
+
+    # Hand the slot straight to the next waiting request, if any
+    def release(self):
+        for priority in (PEER, WALLET):
+            while self.waiting[priority]:
+                future = self.waiting[priority].popleft()
+                if not future.done():
+                    future.set_result(True)
+                    return
+
+        self.free += 1
+
+
+globalBucket = TokenBucket(globalRate, globalBurst)
+peerBucket = TokenBucket(peerRate, peerBurst)
+scheduler = Scheduler(slots, maxWaiting)
+
+
+# Explicit rejection for a request that was turned away, with enough of the request to tell which one it was
+def busy(data):
+    response = {"type": "rejection", "reason": "busy"}
+    for key in ("address", "id"):
+        if key in data:
+            response = {**response, **{key: data[key]}}
+
+    return response
@@ -0,0 +1,163 @@
+import sys
+from collections import OrderedDict
+
+# Memory budget of the decoded block cache, in bytes
+maxBytes = 64 * 1024 * 1024
+
+# Rough cost of a chain's list and height index entries, per block
+entryOverhead = 100
+
+blockFields = ("type", "id", "previous", "address", "link", "balance", "signature")
+
+# Every distinct key order seen so far, so blocks with the same layout share one tuple
+fieldOrders = {}
+
+
+# A decoded block. Much smaller than a dict, but can still be read like one (block["balance"]) so handlers don't
+# care which they get. Remembers its original key order since signatures are over json.dumps of the block.
+class Block:
+    __slots__ = blockFields + ("fields", "extra", "size")
+
+    def __init__(self, data):
+        fields = tuple(data)
+        self.fields = fieldOrders.setdefault(fields, fields)
+        self.extra = None
+        self.size = sys.getsizeof(self)
+        for key, value in data.items():
+            # Every block of an account repeats its address, so they all share one copy
+            if key == "address" and isinstance(value, str):
+                value = sys.intern(value)
+
+            self.size += sys.getsizeof(value)
+
+            if key in blockFields:
+                setattr(self, key, value)
+
+            else:
+                if self.extra is None:
+                    self.extra = {}
+
+                self.extra[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+
+        if key in blockFields:
+            return getattr(self, key)
+
+        return self.extra[key]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+
+        return self[key]
+
+    def keys(self):
+        return self.fields
+
+    # A plain dict with the original key order, e.g. for json.dumps
+    def toDict(self):
+        return {key: self[key] for key in self.fields}
+
+    def copy(self):
+        return self.toDict()
+
+
+# An account's blocks in chain order together with the height of every block ID
+class AccountChain:
+    __slots__ = ("blocks", "heights", "size")
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.heights = {block["id"]: height for height, block in enumerate(blocks)}
+        self.size = sum(block.size for block in blocks) + entryOverhead * len(blocks)
+
+    def append(self, block):
+        self.heights[block["id"]] = len(self.blocks)
+        self.blocks.append(block)
+        self.size += block.size + entryOverhead
+
+    def __len__(self):
+        return len(self.blocks)
+
+
+# Where each block of an account's chain is in its file: the block IDs in chain order and the (start, end) byte range
+# of each one's line. Small enough to keep for accounts that don't fit in (or were evicted from) the LRU, so a page
+# of their chain can be read without decoding the whole file
+class ChainIndex:
+    __slots__ = ("ids", "heights", "offsets")
+
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.heights = {blockID: height for height, blockID in enumerate(ids)}
+        self.offsets = offsets
+
+    def append(self, blockID, offset):
+        self.heights[blockID] = len(self.ids)
+        self.ids.append(blockID)
+        self.offsets.append(offset)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+# Least recently used cache limited by the total size of its values
+class LRUCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+
+        # Never worth evicting everything else for a single value that doesn't fit anyway
+        if value.size > self.maxBytes:
+            return
+
+        self.entries[key] = value
+        self.bytes += value.size
+        self.evict()
+
+    def pop(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.bytes -= value.size
+
+        return value
+
+    # Account for a cached value that changed size in place
+    def resize(self, key, change):
+        if key in self.entries:
+            self.bytes += change
+            self.entries.move_to_end(key)
+            self.evict()
+
+    def evict(self):
+        while self.bytes > self.maxBytes and self.entries:
+            _, value = self.entries.popitem(last=False)
+            self.bytes -= value.size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hitRate = self.hits / lookups if lookups else 0
+        return {"hits": self.hits, "misses": self.misses, "hitRate": hitRate, "evictions": self.evictions, "entries": len(self.entries), "bytes": self.bytes, "maxBytes": self.maxBytes}
@@ -0,0 +1,233 @@
+import base64
+import json
+import weakref
+
+# Use a faster JSON implementation if one is installed. It's only used for the wire format, signatures are always
+# computed over the standard json.dumps output so they stay identical whichever implementation is loaded
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+
+except ImportError:
+    msgpack = None
+
+
+# Plain JSON text frames, understood by every client. orjson is only a shortcut, whatever it can't handle exactly
+# like the json module does goes through the json module instead
+class JSONCodec:
+    name = "json"
+
+    def encode(self, data):
+        if orjson is not None:
+            try:
+                return orjson.dumps(data).decode("utf-8")
+
+            # Integers of 64 bits or more
+            except TypeError:
+                pass
+
+        return json.dumps(data)
+
+    def decode(self, frame):
+        if orjson is not None:
+            data = orjson.loads(frame)
+
+            # orjson turns integers of 64 bits or more into floats, the json module keeps every digit. Floats never
+            # appear in the protocol otherwise, so any float means decoding again
+            if not containsFloat(data):
+                return data
+
+        return json.loads(frame)
+
+
+def containsFloat(data):
+    if isinstance(data, float):
+        return True
+
+    if isinstance(data, dict):
+        return any(containsFloat(value) for value in data.values())
+
+    if isinstance(data, list):
+        return any(containsFloat(item) for item in data)
+
+    return False
+
+
+# Compact binary frames. Keys are shortened, signatures travel as the raw 64 bytes and addresses as their DER bytes
+class MsgpackCodec:
+    name = "msgpack"
+
+    keys = {
+        "type": "t",
+        "action": "c",
+        "address": "a",
+        "id": "i",
+        "previous": "p",
+        "link": "l",
+        "balance": "b",
+        "signature": "s",
+        "reason": "r",
+        "nodes": "n",
+        "sendAmount": "m",
+        "broadCastID": "x",
+        "block": "k",
+        "port": "o",
+        "blocks": "B",
+        "height": "h",
+        "next": "N",
+    }
+    fullKeys = {short: key for key, short in keys.items()}
+
+    def encode(self, data):
+        return msgpack.packb(self.compress(data), use_bin_type=True)
+
+    def decode(self, frame):
+        return self.expand(msgpack.unpackb(frame, raw=False))
+
+    def compress(self, data):
+        if not isinstance(data, dict):
+            return data
+
+        compressed = {}
+        for key, value in data.items():
+            if key == "signature":
+                value = packSignature(value)
+
+            elif key == "address":
+                value = packAddress(value)
+
+            elif isinstance(value, dict):
+                value = self.compress(value)
+
+            elif isinstance(value, list):
+                value = [self.compress(item) for item in value]
+
+            compressed[self.keys.get(key, key)] = value
+
+        return compressed
+
+    def expand(self, data):
+        if not isinstance(data, dict):
+            return data
+
+        expanded = {}
+        for key, value in data.items():
+            key = self.fullKeys.get(key, key)
+            if key == "signature" and isinstance(value, bytes):
+                value = hex(int.from_bytes(value, "little"))
+
+            elif key == "address" and isinstance(value, bytes):
+                value = unpackAddress(value)
+
+            elif isinstance(value, dict):
+                value = self.expand(value)
+
+            elif isinstance(value, list):
+                value = [self.expand(item) for item in value]
+
+            expanded[key] = value
+
+        return expanded
+
+
+# Signatures are hex strings of a little-endian integer, only pack them if they can be restored exactly
+def packSignature(signature):
+    try:
+        packed = int(signature, 16).to_bytes(64, byteorder="little")
+
+    except (TypeError, ValueError, OverflowError):
+        return signature
+
+    if hex(int.from_bytes(packed, "little")) != signature:
+        return signature
+
+    return packed
+
+
+# Addresses are the base64 lines of a PEM public key joined with spaces
+def packAddress(address):
+    try:
+        packed = base64.b64decode(address.replace(" ", ""), validate=True)
+
+    except (AttributeError, ValueError):
+        return address
+
+    if unpackAddress(packed) != address:
+        return address
+
+    return packed
+
+
+def unpackAddress(packed):
+    encoded = base64.b64encode(packed).decode("ascii")
+    return " ".join(encoded[i:i+64] for i in range(0, len(encoded), 64))
+
+
+codecs = {"json": JSONCodec()}
+if msgpack is not None:
+    codecs["msgpack"] = MsgpackCodec()
+
+defaultCodec = codecs["json"]
+
+# Codec negotiated for each open websocket, connections that never negotiated use the default
+connectionCodecs = weakref.WeakKeyDictionary()
+
+
+# Add another codec that can be negotiated by name
+def register(codec):
+    codecs[codec.name] = codec
+
+
+# Pick the first codec offered by the other side that we also support
+def choose(offered):
+    for name in offered:
+        if name in codecs:
+            return codecs[name]
+
+    return defaultCodec
+
+
+def getCodec(websocket):
+    return connectionCodecs.get(websocket, defaultCodec)
+
+
+def setCodec(websocket, codec):
+    connectionCodecs[websocket] = codec
+
+
+# Decode a frame received on websocket. Text frames are always JSON so negotiation can happen on any connection
+def decode(websocket, frame):
+    if isinstance(frame, str):
+        return defaultCodec.decode(frame)
+
+    return getCodec(websocket).decode(frame)
+
+
+def encode(websocket, data):
+    return getCodec(websocket).encode(data)
+
+
+async def send(websocket, data):
+    await websocket.send(encode(websocket, data))
+
+
+async def recv(websocket):
+    return decode(websocket, await websocket.recv())
+
+
+# Ask the node on the other end of websocket to switch to the best codec we both support
+async def negotiate(websocket, preferred=None):
+    if preferred is None:
+        preferred = [name for name in ("msgpack", "json") if name in codecs]
+
+    await websocket.send(defaultCodec.encode({"type": "negotiate", "codecs": preferred}))
+    resp = decode(websocket, await websocket.recv())
+    if resp["type"] == "confirm":
+        setCodec(websocket, choose([resp["codec"]]))
+
+    return getCodec(websocket)
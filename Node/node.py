@@ -2,12 +2,17 @@ import asyncio
 import json
 import aiofiles
 
+import admission
+import cache
+import codec
+
 import websockets
 import aiohttp
 import socket
 
 import os
 import random
+import weakref
 
 from Crypto.Signature import DSS
 from Crypto.Hash import SHA256
@@ -22,6 +27,23 @@ os.makedirs(ledgerDir, exist_ok=True)
 
 nodes = {}
 
+# Decoded chains of recently used accounts (address -> cache.AccountChain), kept up to date by appendBlock
+blockCache = cache.LRUCache(cache.maxBytes)
+
+# Bumped every time an account's file changes, so a chain read before the change is never cached
+ledgerVersions = {}
+
+# One lock per account, held from validating a block until it's written, so two blocks can't both be checked
+# against the same head. Locks disappear again once nobody is using them
+accountLocks = weakref.WeakValueDictionary()
+
+# Block IDs and file offsets of the accounts read so far (address -> cache.ChainIndex). Never evicted, so paging
+# through an account that doesn't fit in blockCache doesn't decode its whole file for every page
+chainIndexes = {}
+
+defaultPageSize = 100
+maxPageSize = 1000
+
 ip = -1
 myPort = -1
 
@@ -34,10 +56,10 @@ async def balance(data):
         block = await getHead(address)
 
     except FileNotFoundError:
-        response = f'{{"type": "rejection", "address": "{address}", "reason": "addressNonExistent"}}'
+        response = {"type": "rejection", "address": address, "reason": "addressNonExistent"}
         return response
 
-    response = f'{{"type": "info", "address": "{address}", "balance": "{block["balance"]}" }}'
+    response = {"type": "info", "address": address, "balance": str(block["balance"])}
     return response
 
 
@@ -51,9 +73,9 @@ async def broadcast(data):
     for node in nodes:
         ws = nodes[node]
         try:
-            await ws.send('{"type": "ping"}')
-            resp = await ws.recv()
-            if json.loads(resp)["type"] == "confirm":
+            await codec.send(ws, {"type": "ping"})
+            resp = await codec.recv(ws)
+            if resp["type"] == "confirm":
                 print("Available", node)
                 validNodesStr = validNodesStr + "|" + node
                 validNodes.append(node)
@@ -63,9 +85,9 @@ async def broadcast(data):
 
     packet = {"type": "broadcast", "broadCastID": broadcastID, "nodes": validNodesStr, "block": data}
     for node in validNodes:
-        await nodes[node].send(json.dumps(packet))
-        resp = await nodes[node].recv()
-        if json.loads(resp)["type"] == "rejection":
+        await codec.send(nodes[node], packet)
+        resp = await codec.recv(nodes[node])
+        if resp["type"] == "rejection":
             print("Transaction rejected by ", node)
             break
 
@@ -74,29 +96,19 @@ async def broadcast(data):
 async def checkForPendingSend(data):
     address = data["address"]
 
-    received = []
+    received = set()
     accounts = os.listdir(ledgerDir)
     if address in accounts:
-        f = await aiofiles.open(ledgerDir + address)
-        data = await f.read()
-        await f.close()
-
-        data = data.splitlines()
-        for block in data:
-            block = json.loads(block)
+        for block in await getChain(address):
             if block["type"] == "receive":
-                received.append(block["link"])
+                received.add(block["link"])
 
             if block["type"] == "open":
-                received.append(block["link"])
+                received.add(block["link"])
 
+    # Scanning the whole ledger would push every hot account out of the cache, so read past it
     for i in accounts:
-        f = await aiofiles.open(f"{ledgerDir}{i}")
-        blocks = await f.read()
-        await f.close()
-        blocks = blocks.splitlines()
-        for block in blocks:
-            block = json.loads(block)
+        for block in await getChain(i, fill=False):
             if f'{block["address"]}/{block["id"]}' in received:
                 continue
 
@@ -106,11 +118,20 @@ async def checkForPendingSend(data):
                     amount = int(amount["balance"]) - int(block["balance"])
 
                     resp = {"type": "pendingSend", "link": f"{block['address']}/{block['id']}", "sendAmount": amount}
-                    resp = json.dumps(resp)
                     return resp
 
     response = {"type": "pendingSend", "link": "", "sendAmount": ""}
-    return json.dumps(response)
+    return response
+
+
+# Return the lock that serialises changes to an account
+def getAccountLock(address):
+    lock = accountLocks.get(address)
+    if lock is None:
+        lock = asyncio.Lock()
+        accountLocks[address] = lock
+
+    return lock
 
 
 # Return a list of available nodes
@@ -121,62 +142,244 @@ async def fetchNodes():
         nodeAddresses = nodeAddresses + "|" + node
 
     response = {"type": "confirm", "action": "fetchNodes", "nodes": nodeAddresses}
-    return json.dumps(response)
+    return response
 
 
 # Return a block belonging to the account (address) with block ID (blockID)
 async def getBlock(address, blockID):
-    f = await aiofiles.open(f"{ledgerDir}{address}")
-    fileStr = await f.read()
-    await f.close()
-    fileStr = fileStr.splitlines()
-
-    blocks = []
-    for block in fileStr:
-        blocks.append(json.loads(block))
-
-    for block in blocks:
-        if block["id"] == blockID:
-            return block
+    account = await getAccount(address)
+    if blockID in account.heights:
+        return account.blocks[account.heights[blockID]]
 
     print("not found")
 
 
 # Get the head block of an account (the most recent block)
 async def getHead(address):
-    f = await aiofiles.open(f"{ledgerDir}{address}")
-    fileStr = await f.read()
+    chain = await getChain(address)
+    return chain[-1]
+
+
+# Return an account's blocks in chain order
+async def getChain(address, fill=True):
+    account = await getAccount(address, fill)
+    return account.blocks
+
+
+# Return an account's decoded, ordered chain. Only reads the account's file if it isn't in the cache.
+# With fill=False (for full ledger scans) the cache is used if it has the account but isn't touched otherwise, so
+# neither its contents, its LRU order nor its hit rate change
+async def getAccount(address, fill=True):
+    if fill:
+        account = blockCache.get(address)
+
+    else:
+        account = blockCache.entries.get(address)
+
+    while account is None:
+        version = ledgerVersions.get(address, 0)
+        chain, offsets = await readLedger(address)
+
+        # Another connection appended to (or fetchLedger rewrote) the file while we were reading it, read it again
+        if ledgerVersions.get(address, 0) != version:
+            continue
+
+        account = blockCache.entries.get(address)
+        if account is not None:
+            break
+
+        account = cache.AccountChain(chain)
+        if fill:
+            chainIndexes[address] = cache.ChainIndex([block["id"] for block in chain], offsets)
+            blockCache.put(address, account)
+
+    return account
+
+
+# Read and decode an account's file. Returns its blocks in chain order and the byte range of each block's line
+async def readLedger(address):
+    f = await aiofiles.open(f"{ledgerDir}{address}", "rb")
+    fileBytes = await f.read()
     await f.close()
-    fileStr = fileStr.splitlines()
-
-    blocks = []
-    for block in fileStr:
-        blocks.append(json.loads(block))
-
-    if len(blocks) == 1:
-        return blocks[0]
-
-    # Sort blocks in order
-    isSorted = False
-    while not isSorted:
-        isSorted = True
-        for i in range(1, len(blocks)):
-            previous = blocks[i]["previous"]
-            if previous == "0"*20:  # if broken, change to 145
-                blocks.insert(0, blocks.pop(i))
-                continue
 
-            if blocks[i-1]["id"] == previous:
-                continue
+    entries = []
+    start = 0
+    for line in fileBytes.split(b"\n"):
+        end = start + len(line)
+        if line.strip() != b"":
+            entries.append((cache.Block(json.loads(line)), (start, end)))
+
+        start = end + 1
+
+    # Follow the previous links from the open (or genesis) block
+    byPrevious = {}
+    for entry in entries:
+        byPrevious[entry[0]["previous"]] = entry
+
+    chain = []
+    entry = byPrevious.get("0"*20)
+    while entry is not None and len(chain) < len(entries):
+        chain.append(entry)
+        entry = byPrevious.get(entry[0]["id"])
 
-            isSorted = False
+    # Broken chain, fall back to the order the blocks were written in
+    if len(chain) != len(entries):
+        chain = entries
 
-            for x in range(len(blocks)):
-                if blocks[x]["id"] == previous:
-                    blocks.insert(x+1, blocks.pop(i))
-                    break
+    return [block for block, _ in chain], [offset for _, offset in chain]
 
-    return blocks[-1]
+
+# Read the blocks at heights start to end of an account's chain straight from its file, using the offsets in its
+# index. Returns None if the file changed while it was being read
+async def readBlocks(address, index, start, end):
+    offsets = index.offsets[start:end]
+    if not offsets:
+        return []
+
+    first = min(offset[0] for offset in offsets)
+    last = max(offset[1] for offset in offsets)
+
+    version = ledgerVersions.get(address, 0)
+    f = await aiofiles.open(f"{ledgerDir}{address}", "rb")
+    await f.seek(first)
+    pageBytes = await f.read(last - first)
+    await f.close()
+
+    if ledgerVersions.get(address, 0) != version:
+        return None
+
+    return [cache.Block(json.loads(pageBytes[offset[0]-first:offset[1]-first])) for offset in offsets]
+
+
+# Write a confirmed block to its account's file and add it to the cached chain and the account's index
+async def appendBlock(block):
+    address = block["address"]
+    path = f"{ledgerDir}{address}"
+
+    # Bumped before writing, so a getAccount that might have read the file without this block won't cache it
+    ledgerVersions[address] = ledgerVersions.get(address, 0) + 1
+
+    # Ledger files fetched from other nodes don't end with a newline
+    size = 0
+    separator = b""
+    if os.path.exists(path):
+        size = os.path.getsize(path)
+
+    if size > 0:
+        f = await aiofiles.open(path, "rb")
+        await f.seek(-1, os.SEEK_END)
+        if await f.read(1) != b"\n":
+            separator = b"\n"
+
+        await f.close()
+
+    line = json.dumps(block).encode("utf-8")
+    f = await aiofiles.open(path, "ab")
+    await f.write(separator + line + b"\n")
+    await f.close()
+
+    # A getAccount that started after the version bump may have read this block already
+    index = chainIndexes.get(address)
+    if index is not None and block["id"] not in index.heights:
+        offset = size + len(separator)
+        index.append(block["id"], (offset, offset + len(line)))
+
+    account = blockCache.entries.get(address)
+    if account is not None and block["id"] not in account.heights:
+        block = cache.Block(block)
+        account.append(block)
+        blockCache.resize(address, block.size)
+
+
+# Heights and page sizes can arrive as numbers or as strings of digits
+def parseCount(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+
+    return None
+
+
+# Return a page of an account's blocks in chain order, starting from the block ID "from" or the height "height"
+# (the first block is height 0). "next" is the ID to pass as "from" for the next page, or "" on the last page.
+# Chains in the cache are paged from memory, otherwise only the page's lines are read from the account's file
+async def getBlockRange(data):
+    address = data["address"]
+
+    height = parseCount(data.get("height", 0))
+    if height is None or height < 0:
+        return None, {"type": "rejection", "address": address, "reason": "invalidHeight"}
+
+    limit = parseCount(data.get("limit", defaultPageSize))
+    if limit is None or limit < 1:
+        return None, {"type": "rejection", "address": address, "reason": "invalidLimit"}
+
+    limit = min(limit, maxPageSize)
+
+    blockID = data.get("from", "")
+    if not isinstance(blockID, str):
+        return None, {"type": "rejection", "address": address, "reason": "blockNotFound"}
+
+    page = None
+    while page is None:
+        account = blockCache.get(address)
+        index = chainIndexes.get(address)
+        if account is None and index is None:
+            try:
+                account = await getAccount(address)
+
+            except FileNotFoundError:
+                return None, {"type": "rejection", "address": address, "reason": "addressNonExistent"}
+
+        chain = account if account is not None else index
+        if blockID != "":
+            if blockID not in chain.heights:
+                return None, {"type": "rejection", "address": address, "reason": "blockNotFound"}
+
+            start = chain.heights[blockID]
+
+        else:
+            start = height
+
+        if account is not None:
+            page = account.blocks[start:start+limit]
+
+        else:
+            page = await readBlocks(address, index, start, start+limit)
+
+    nextBlock = ""
+    if start + limit < len(chain):
+        if account is not None:
+            nextBlock = account.blocks[start+limit]["id"]
+
+        else:
+            nextBlock = index.ids[start+limit]
+
+    return page, {"address": address, "height": start, "next": nextBlock}
+
+
+# Return a page of an account's history: what each block did, without signatures
+async def history(data):
+    page, response = await getBlockRange(data)
+    if page is None:
+        return response
+
+    entries = []
+    for height, block in enumerate(page, response["height"]):
+        entries.append({"height": height, "type": block["type"], "id": block["id"], "link": block["link"], "balance": str(block["balance"])})
+
+    return {**{"type": "history"}, **response, **{"blocks": entries}}
+
+
+# Return a page of an account's full signed blocks
+async def blocks(data):
+    page, response = await getBlockRange(data)
+    if page is None:
+        return response
+
+    return {**{"type": "blocks"}, **response, **{"blocks": [block.toDict() for block in page]}}
 
 
 # Process an open transaction
@@ -187,7 +390,7 @@ async def openAccount(data):
 
     valid = await verifySignature(signature, address, data)
     if not valid:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "signature"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "signature"}
         return toRespond
 
     sendingAddress, sendingBlock = data["link"].split("/")
@@ -196,21 +399,21 @@ async def openAccount(data):
     # Check that send block is valid
     valid = await verifySignature(sendingBlock["signature"], sendingAddress, sendingBlock)
     if not valid:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "sendSignature"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "sendSignature"}
         return toRespond
 
     previousBlock = await getBlock(sendingAddress, sendingBlock["previous"])
     sendAmount = int(previousBlock["balance"]) - int(sendingBlock["balance"])
 
     if int(data["balance"]) != int(sendAmount):
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "invalidBalance"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "invalidBalance"}
         return toRespond
 
     if data["previous"] != "0"*20:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "invalidPrevious"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "invalidPrevious"}
         return toRespond
 
-    toRespond = f'{{"type": "confirm", "address": "{address}", "id": "{blockID}"}}'
+    toRespond = {"type": "confirm", "address": address, "id": blockID}
     return toRespond
 
 
@@ -222,7 +425,7 @@ async def receive(data):
 
     valid = await verifySignature(signature, address, data)
     if not valid:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "signature"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "signature"}
         return toRespond
 
     sendingAddress, sendingBlock = data["link"].split("/")
@@ -231,51 +434,68 @@ async def receive(data):
     # Check that send block is valid
     valid = await verifySignature(sendingBlock["signature"], sendingAddress, sendingBlock)
     if not valid:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "sendSignature"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "sendSignature"}
         return toRespond
     
-    f = await aiofiles.open(f"{ledgerDir}{address}")
-    blocks = await f.read()
-    await f.close()
-    blocks = blocks.splitlines()
-    for block in blocks:
-        if json.loads(block)["link"] == data["link"]:
+    for block in await getChain(address):
+        if block["link"] == data["link"]:
             response = {"type": "rejection", "address": address, "id": blockID, "reason": "doubleReceive"}
-            return json.dumps(response)
+            return response
 
     previousBlock = await getBlock(sendingAddress, sendingBlock["previous"])
     sendAmount = previousBlock["balance"] - int(sendingBlock["balance"])
 
     head = await getHead(address)
     if int(data["balance"]) != int(head["balance"]) + int(sendAmount):
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "invalidBalance"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "invalidBalance"}
         return toRespond
 
     if data["previous"] != head["id"]:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "invalidPrevious"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "invalidPrevious"}
         return toRespond
 
-    toRespond = f'{{"type": "confirm", "address": "{address}", "id": "{blockID}"}}'
+    toRespond = {"type": "confirm", "address": address, "id": blockID}
     return toRespond
 
 
+# Add the other end of websocket as a peer. Anyone can send registerNode, so only accept it once a node actually
+# answers on the port it gave
+async def registerNode(websocket, data):
+    global nodes
+    port = str(data["port"])
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        response = {"type": "rejection", "action": "registerNode", "reason": "invalidPort"}
+        return response
+
+    node = f"ws://{websocket.remote_address[0]}:{int(port)}"
+    if not await testWebsocket(node):
+        response = {"type": "rejection", "action": "registerNode", "reason": "unverifiedNode"}
+        return response
+
+    nodes = {**nodes, **{node: websocket}}
+    response = {"type": "confirm", "action": "registerNode"}
+    return response
+
+
 # Register myself with specified node
 async def registerMyself(node):
     global myPort
     global ip
     print(f"Registering with {node}")
     websocket = await websockets.connect(node)
-    await websocket.send(f'{{"type": "registerNode", "port": "{myPort}"}}')
-    resp = await websocket.recv()
-    if json.loads(resp)["type"] == "confirm":
+    await codec.send(websocket, {"type": "registerNode", "port": str(myPort)})
+    resp = await codec.recv(websocket)
+    if resp["type"] == "confirm":
         print(f"Node registered with: {node}")
         global nodes
         nodes = {**nodes, **{node: websocket}}
 
-        await websocket.send('{"type": "fetchNodes"}')
-        newNodes = await websocket.recv()
+        await codec.negotiate(websocket)
+
+        await codec.send(websocket, {"type": "fetchNodes"})
+        newNodes = await codec.recv(websocket)
         print(newNodes)
-        newNodes = json.loads(newNodes)["nodes"].split("|")[1:]
+        newNodes = newNodes["nodes"].split("|")[1:]
         print(newNodes)
         for node in newNodes:
             nodeIP = node.replace("ws://", "").split(":")[0]
@@ -299,19 +519,19 @@ async def send(data):
 
     valid = await verifySignature(signature, address, data)
     if not valid:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "signature"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "signature"}
         return toRespond
 
     head = await getHead(address)
     if int(head["balance"]) < int(data["balance"]):
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "balance"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "balance"}
         return toRespond
 
     if head["id"] != data["previous"]:
-        toRespond = f'{{"type": "rejection", "address": "{address}", "id": "{blockID}", "reason": "invalidPrevious"}}'
+        toRespond = {"type": "rejection", "address": address, "id": blockID, "reason": "invalidPrevious"}
         return toRespond
 
-    toRespond = f'{{"type": "confirm", "address": "{address}", "id": "{blockID}"}}'
+    toRespond = {"type": "confirm", "address": address, "id": blockID}
     return toRespond
 
 
@@ -420,14 +640,8 @@ async def verifyLedger():
     accounts = {}
     accountsDir = os.listdir(ledgerDir)
     for account in accountsDir:
-        f = await aiofiles.open(ledgerDir + account)
-        data = await f.read()
-        await f.close()
-
         blocks = {}
-        data = data.splitlines()
-        for block in data:
-            block = json.loads(block)
+        for block in await getChain(account, fill=False):
             blocks[block["id"]] = [block, None]
 
         accounts[account] = blocks
@@ -448,71 +662,174 @@ async def verifyLedger():
     print("Ledger Verified!")
 
 
-# Handles incoming websocket connections
-async def incoming(websocket, path):
+# Process a single decoded request and return the response. Returns None if the response was already sent
+async def handleRequest(websocket, data):
     global nodes
-    print(f"Client Connected: {websocket.remote_address[0]}")
-    while True:
-        try:
-            data = await websocket.recv()
-
-        except:
-            print("Client Disconnected")
-            for node in nodes:
-                if websocket.remote_address[0] in node:
-                    nodes.pop(node)
-
-            break
-
-        print(data)
-        data = json.loads(data)
-        if data["type"] == "ping":
-            response = '{"type": "confirm", "action": "ping"}'
+    if data["type"] == "ping":
+        response = {"type": "confirm", "action": "ping"}
 
-        elif data["type"] == "balance":
-            response = await balance(data)
+    elif data["type"] == "balance":
+        response = await balance(data)
 
-        elif data["type"] == "send":
+    elif data["type"] == "send":
+        async with getAccountLock(data["address"]):
             response = await send(data)
-            if json.loads(response)["type"] == "confirm":
-                f = await aiofiles.open(f"{ledgerDir}{data['address']}", "a")
-                await f.write(json.dumps(data))
-                await f.close()
+            if response["type"] == "confirm":
+                await appendBlock(data)
 
-        elif data["type"] == "pendingSend":
-            response = await checkForPendingSend(data)
+    elif data["type"] == "pendingSend":
+        response = await checkForPendingSend(data)
 
-        elif data["type"] == "receive":
+    elif data["type"] == "receive":
+        async with getAccountLock(data["address"]):
             response = await receive(data)
-            if json.loads(response)["type"] == "confirm":
-                f = await aiofiles.open(f"{ledgerDir}{data['address']}", "a")
-                await f.write(json.dumps(data))
-                await f.close()
+            if response["type"] == "confirm":
+                await appendBlock(data)
 
-        elif data["type"] == "open":
+    elif data["type"] == "open":
+        async with getAccountLock(data["address"]):
             response = await openAccount(data)
-            if json.loads(response)["type"] == "confirm":
-                f = await aiofiles.open(f"{ledgerDir}{data['address']}", "a+")
-                await f.write(json.dumps(data))
-                await f.close()
+            if response["type"] == "confirm":
+                await appendBlock(data)
 
-        elif data["type"] == "getPrevious":
-            head = await getHead(data["address"])
-            address = data["address"]
-            previous = head["id"]
-            response = f'{{"type": "previous", "address": "{address}", "link": "{previous}"}}'
+    elif data["type"] == "getPrevious":
+        head = await getHead(data["address"])
+        address = data["address"]
+        previous = head["id"]
+        response = {"type": "previous", "address": address, "link": previous}
 
-        elif data["type"] == "registerNode":
-            response = json.dumps({"type": "confirm", "action": "registerNode"})
-            nodes = {**nodes, **{f"ws://{websocket.remote_address[0]}:{data['port']}": websocket}}
+    elif data["type"] == "history":
+        response = await history(data)
 
-        elif data["type"] == "fetchNodes":
-            response = await fetchNodes()
+    elif data["type"] == "blocks":
+        response = await blocks(data)
 
-        else:
-            response = f'{{"type": "rejection", "reason": "unknown request"}}'
+    elif data["type"] == "cacheStats":
+        response = {**{"type": "info", "action": "cacheStats"}, **blockCache.stats()}
+
+    elif data["type"] == "registerNode":
+        response = await registerNode(websocket, data)
+
+    elif data["type"] == "fetchNodes":
+        response = await fetchNodes()
+
+    elif data["type"] == "negotiate":
+        # The confirmation still goes out in the old codec, everything after it uses the new one. The codec is
+        # switched before sending so frames read right after the confirmation are already decoded with it
+        chosen = codec.choose(data["codecs"])
+        confirmation = codec.encode(websocket, {"type": "confirm", "action": "negotiate", "codec": chosen.name})
+        codec.setCodec(websocket, chosen)
+        await websocket.send(confirmation)
+        response = None
+
+    else:
+        response = {"type": "rejection", "reason": "unknown request"}
+
+    return response
+
+
+# Read requests from a connection into its queue, turning away anything over the rate limits.
+# Each queued item is (request, rejection), rejections are queued too so responses still go out in request order.
+async def readRequests(websocket, requests, bucket):
+    cancelled = False
+    try:
+        while True:
+            try:
+                data = await websocket.recv()
+
+            except Exception:
+                break
+
+            print(data)
+            try:
+                data = codec.decode(websocket, data)
+                if not isinstance(data, dict) or not isinstance(data.get("type"), str):
+                    raise ValueError("request has no type")
+
+                requestType = data["type"]
+
+            except (ValueError, TypeError, KeyError):
+                await requests.put((None, {"type": "rejection", "reason": "malformed"}))
+                continue
+
+            # Besides their connection's bucket, peers share one bucket and wallets another
+            cost = admission.cost(requestType)
+            peer = websocket in nodes.values()
+            shared = admission.peerBucket if peer else admission.globalBucket
+            if not bucket.take(cost) or not shared.take(cost):
+                await requests.put((data, admission.busy(data)))
+                continue
 
-        await websocket.send(response)
+            # Waits here when the queue is full, so a client sending too fast just stops being read
+            await requests.put((data, None))
+
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+
+    except Exception as e:
+        print(f"Failed to read from client: {e!r}")
+
+    finally:
+        # However the reader stopped, incoming must hear about it or it waits for requests forever
+        if not cancelled:
+            await requests.put(None)
+
+
+# Handles incoming websocket connections
+async def incoming(websocket, path):
+    global nodes
+    print(f"Client Connected: {websocket.remote_address[0]}")
+    requests = asyncio.Queue(admission.queueSize)
+    bucket = admission.TokenBucket(admission.connectionRate, admission.connectionBurst)
+    reader = asyncio.create_task(readRequests(websocket, requests, bucket))
+    try:
+        while True:
+            request = await requests.get()
+            if request is None:
+                print("Client Disconnected")
+                for node in list(nodes):
+                    if websocket.remote_address[0] in node:
+                        nodes.pop(node)
+
+                break
+
+            data, response = request
+            if response is None:
+                peer = websocket in nodes.values()
+                if not await admission.scheduler.acquire(admission.PEER if peer else admission.WALLET):
+                    response = admission.busy(data)
+
+                else:
+                    try:
+                        response = await handleRequest(websocket, data)
+
+                    except Exception as e:
+                        print(f"Invalid {data['type']} request: {e!r}")
+                        response = {"type": "rejection", "reason": "invalidRequest"}
+
+                    finally:
+                        admission.scheduler.release()
+
+            if response is None:
+                continue
+
+            try:
+                frame = codec.encode(websocket, response)
+
+            except Exception as e:
+                print(f"Failed to encode response: {e!r}")
+                frame = codec.encode(websocket, {"type": "rejection", "reason": "unencodableResponse"})
+
+            # A closed connection is picked up by the reader, which then ends this loop
+            try:
+                await websocket.send(frame)
+
+            except Exception as e:
+                print(f"Failed to send response: {e!r}")
+
+    finally:
+        reader.cancel()
 
 
 # Handles incoming ledger requests
@@ -553,16 +870,20 @@ async def fetchLedger(node):
         await f.write(toWrite)
         await f.close()
 
+        ledgerVersions[account] = ledgerVersions.get(account, 0) + 1
+        chainIndexes.pop(account, None)
+        blockCache.pop(account)
+
 
 # Check if node running on given url
 async def testWebsocket(url):
     try:
         websocket = await asyncio.wait_for(websockets.connect(url), 3)
-        await websocket.send('{"type": "ping"}')
-        await websocket.recv()
+        await codec.send(websocket, {"type": "ping"})
+        resp = await asyncio.wait_for(codec.recv(websocket), 3)
         await websocket.close()
 
-        return True
+        return resp["type"] == "confirm"
 
     except:
         return False
@@ -0,0 +1,315 @@
+# Programmatic wallet client for sending lots of transactions at once
+#
+#   async with WalletClient(["ws://localhost:6969"]) as client:
+#       account = Account.fromFile("private.pem")
+#       transfers = await client.payout([(account, destination, 10) for destination in destinations])
+#       for transfer in transfers:
+#           print(transfer.id, transfer.status, transfer.reason)
+#
+# Blocks for every account are built on a locally tracked head, signed in a process pool and then pipelined over
+# a pool of connections, so a whole chain of sends only waits for the node once.
+
+import asyncio
+import json
+import random
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import websockets
+
+from Crypto.PublicKey import ECC
+from Crypto.Hash import SHA256
+from Crypto.Signature import DSS
+
+
+# Private keys already imported by this (worker) process, keyed by their PEM
+importedKeys = {}
+
+
+# Sign a list of blocks with one private key. Runs in the worker processes, so the key is passed as PEM
+def signChain(privateKeyPem, blocks):
+    privateKey = importedKeys.get(privateKeyPem)
+    if privateKey is None:
+        privateKey = ECC.import_key(privateKeyPem)
+        importedKeys[privateKeyPem] = privateKey
+
+    signer = DSS.new(privateKey, "deterministic-rfc6979")
+    signatures = []
+    for block in blocks:
+        signature = signer.sign(SHA256.new(json.dumps(block).encode("utf-8")))
+        signatures.append(hex(int.from_bytes(signature, "little")))
+
+    return signatures
+
+
+def newBlockID():
+    blockID = str(random.randint(0, 99999999999999999999))
+    return "0"*(20-len(blockID)) + blockID
+
+
+# An account (keypair) together with the locally tracked head and balance of its chain
+class Account:
+    def __init__(self, privateKey):
+        self.privateKey = privateKey
+        self.privateKeyPem = privateKey.export_key(format="PEM")
+
+        address = privateKey.public_key().export_key(format="PEM", compress=True)
+        address = address.replace("-----BEGIN PUBLIC KEY-----\n", "")
+        address = address.replace("\n-----END PUBLIC KEY-----", "")
+        self.address = address.replace("\n", " ")
+
+        self.head = None  # None until synced or if the account hasn't been opened
+        self.balance = 0
+        self.synced = False
+
+    @classmethod
+    def generate(cls):
+        return cls(ECC.generate(curve="P-256"))
+
+    @classmethod
+    def fromFile(cls, privateFile):
+        with open(privateFile, "rt") as f:
+            return cls(ECC.import_key(f.read()))
+
+
+# A single payment and its status: "pending", "confirmed", "rejected" or "failed" (connection problems)
+class Transfer:
+    def __init__(self, account, destination, amount):
+        self.account = account
+        self.destination = destination
+        self.amount = int(amount)
+        self.id = None
+        self.block = None
+        self.status = "pending"
+        self.reason = None
+
+    def __repr__(self):
+        return f"Transfer({self.id}, {self.amount} -> {self.destination[:16]}..., {self.status}, {self.reason})"
+
+
+# A websocket to a node that can have many requests in flight. The node answers requests on a connection in the
+# order it received them, so responses are matched to requests first in, first out.
+class Connection:
+    def __init__(self, uri, maxInFlight=256):
+        self.uri = uri
+        self.websocket = None
+        self.reader = None
+        self.waiting = deque()
+        self.window = asyncio.Semaphore(maxInFlight)
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.uri)
+        self.reader = asyncio.create_task(self.readResponses())
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+
+        if self.reader is not None:
+            await self.reader
+
+    async def readResponses(self):
+        try:
+            async for message in self.websocket:
+                # Nothing we asked for, e.g. something broadcast by the node
+                if not self.waiting:
+                    print(f"Ignoring unexpected message from {self.uri}: {message[:100]}")
+                    continue
+
+                future = self.waiting.popleft()
+                if not future.done():
+                    future.set_result(json.loads(message))
+
+        except websockets.ConnectionClosed:
+            pass
+
+        finally:
+            while self.waiting:
+                future = self.waiting.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to {self.uri} closed"))
+
+    # Send a request without waiting for its response. Returns a future for the response
+    async def submit(self, data):
+        await self.window.acquire()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda _: self.window.release())
+        self.waiting.append(future)
+        try:
+            await self.websocket.send(json.dumps(data))
+
+        except Exception as e:
+            # The request never went out, so no response will come for it either
+            if future in self.waiting:
+                self.waiting.remove(future)
+
+            if not future.done():
+                future.set_exception(ConnectionError(str(e)))
+
+        return future
+
+    async def request(self, data):
+        return await (await self.submit(data))
+
+
+class WalletClient:
+    def __init__(self, nodes, connectionsPerNode=2, maxInFlight=256, processes=None, chunkSize=512):
+        self.nodes = nodes
+        self.connectionsPerNode = connectionsPerNode
+        self.maxInFlight = maxInFlight
+        self.processes = processes
+        self.chunkSize = chunkSize
+        self.connections = []
+        self.pool = None
+
+    async def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.processes)
+        for node in self.nodes:
+            for _ in range(self.connectionsPerNode):
+                connection = Connection(node, self.maxInFlight)
+                await connection.connect()
+                self.connections.append(connection)
+
+    async def close(self):
+        for connection in self.connections:
+            await connection.close()
+
+        self.connections = []
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # Every account always uses the same connection so the blocks of its chain reach the node in order
+    def connectionFor(self, account):
+        return self.connections[zlib.crc32(account.address.encode("utf-8")) % len(self.connections)]
+
+    # Fetch an account's head and balance from its node. Anything but an unknown account (e.g. the node being busy)
+    # leaves the account unsynced, so nothing gets signed on top of state we don't know
+    async def sync(self, account):
+        account.synced = False
+        connection = self.connectionFor(account)
+        resp = await connection.request({"type": "balance", "address": account.address})
+        if resp["type"] == "rejection":
+            if resp.get("reason") != "addressNonExistent":
+                return
+
+            account.head = None
+            account.balance = 0
+
+        else:
+            balance = int(resp["balance"])
+            resp = await connection.request({"type": "getPrevious", "address": account.address})
+            if resp["type"] != "previous":
+                return
+
+            account.head = resp["link"]
+            account.balance = balance
+
+        account.synced = True
+
+    async def balance(self, account):
+        await self.sync(account)
+        return account.balance
+
+    # Build the chain of send blocks for one account on top of its local head. Doesn't touch the account itself,
+    # that only advances once the node confirms the blocks.
+    def buildChain(self, account, transfers):
+        previous = account.head
+        balance = account.balance
+        chain = []
+        for transfer in transfers:
+            if previous is None:
+                transfer.status = "rejected"
+                transfer.reason = "addressNonExistent"
+                continue
+
+            if transfer.amount <= 0 or transfer.amount > balance:
+                transfer.status = "rejected"
+                transfer.reason = "balance"
+                continue
+
+            balance -= transfer.amount
+            transfer.id = newBlockID()
+            transfer.block = {"type": "send", "address": account.address, "link": transfer.destination, "balance": f"{balance}", "id": transfer.id, "previous": previous}
+            previous = transfer.id
+            chain.append(transfer)
+
+        return chain
+
+    # Sign a chain in chunks spread over the process pool
+    async def signChain(self, account, chain):
+        loop = asyncio.get_running_loop()
+        chunks = [chain[i:i+self.chunkSize] for i in range(0, len(chain), self.chunkSize)]
+        jobs = [loop.run_in_executor(self.pool, signChain, account.privateKeyPem, [transfer.block for transfer in chunk]) for chunk in chunks]
+        for chunk, signatures in zip(chunks, await asyncio.gather(*jobs)):
+            for transfer, signature in zip(chunk, signatures):
+                transfer.block = {**transfer.block, **{"signature": signature}}
+
+    # Pipeline a signed chain to the account's node and record the outcome of every block
+    async def submitChain(self, account, chain):
+        connection = self.connectionFor(account)
+        futures = []
+        for transfer in chain:
+            futures.append(await connection.submit(transfer.block))
+
+        resync = False
+        for transfer, future in zip(chain, futures):
+            try:
+                resp = await future
+
+            except ConnectionError as e:
+                transfer.status = "failed"
+                transfer.reason = str(e)
+                resync = True
+                continue
+
+            if resp["type"] == "confirm" and resp.get("id") == transfer.id:
+                transfer.status = "confirmed"
+                account.head = transfer.id
+                account.balance = int(transfer.block["balance"])
+
+            else:
+                transfer.status = "rejected"
+                transfer.reason = resp.get("reason", resp["type"])
+                resync = True
+
+        # Once a block is rejected the rest of the chain was built on the wrong head, so get the real one back
+        if resync:
+            try:
+                await self.sync(account)
+
+            except ConnectionError:
+                pass
+
+    # Send many transfers. Each transfer is a Transfer or an (account, destination, amount) tuple.
+    # Returns the transfers in the order given, each with its final status.
+    async def payout(self, transfers):
+        transfers = [t if isinstance(t, Transfer) else Transfer(*t) for t in transfers]
+
+        byAccount = {}
+        for transfer in transfers:
+            byAccount.setdefault(transfer.account, []).append(transfer)
+
+        # A connection error just leaves that account unsynced, its transfers are marked failed below
+        await asyncio.gather(*[self.sync(account) for account in byAccount if not account.synced], return_exceptions=True)
+        for account, accountTransfers in byAccount.items():
+            if not account.synced:
+                for transfer in accountTransfers:
+                    transfer.status = "failed"
+                    transfer.reason = "sync"
+
+        byAccount = {account: accountTransfers for account, accountTransfers in byAccount.items() if account.synced}
+
+        chains = {account: self.buildChain(account, accountTransfers) for account, accountTransfers in byAccount.items()}
+        await asyncio.gather(*[self.signChain(account, chain) for account, chain in chains.items() if chain])
+        await asyncio.gather(*[self.submitChain(account, chain) for account, chain in chains.items() if chain])
+
+        return transfers
@@ -65,77 +65,110 @@ publicKeyStr = publicKeyStr.replace("\n-----END PUBLIC KEY-----", "")
 publicKeyStr = publicKeyStr.replace("\n", " ")
 print(publicKeyStr)
 
-doBackgroundCheck = True
+# Ok, so websockets don't link data at all. If the background loop sends something while main is doing something else, main will get its response instead, so every request/response pair holds this lock.
+websocketLock = asyncio.Lock()
+
+# Local copy of the account's chain state. It's seeded once from the node and then advanced with every block the node confirms, so signing a block doesn't need any extra round trips.
+head = None  # ID of the account's most recent block, None if the account hasn't been opened yet
+balance = 0
+synced = False  # False until head and balance are known to match the node, e.g. when the node was busy
+
+
+# Fetch the account's head and balance from the node. Only needed on startup or after a block is rejected.
+# Returns whether it worked, anything but an unknown account (e.g. the node being busy) leaves the old state alone.
+async def syncState(websocket):
+    global head
+    global balance
+    global synced
+
+    synced = False
+    await websocket.send(f'{{"type": "balance", "address": "{publicKeyStr}"}}')
+    resp = json.loads(await websocket.recv())
+
+    if resp["type"] == "rejection":
+        if resp.get("reason") != "addressNonExistent":
+            return False
+
+        head = None
+        balance = 0
+        synced = True
+        return True
+
+    newBalance = int(resp["balance"])
+
+    await websocket.send(f'{{"type": "getPrevious", "address": "{publicKeyStr}"}}')
+    resp = json.loads(await websocket.recv())
+    if resp["type"] != "previous":
+        return False
+
+    head = resp["link"]
+    balance = newBalance
+    synced = True
+    return True
+
+
+# Sign and submit a block built on the local head, then advance or resync the local state depending on the answer
+async def submitBlock(websocket, block):
+    global head
+    global balance
+
+    signature = await genSignature(block, privateKey)
+    block = {**block, **{"signature": signature}}
+
+    await websocket.send(json.dumps(block))
+    resp = await websocket.recv()
+    print(resp)
+
+    if json.loads(resp)["type"] == "confirm":
+        head = block["id"]
+        balance = int(block["balance"])
+
+    else:
+        await syncState(websocket)
+
+
+# Receive the oldest send to this account that hasn't been received yet, if there is one
+async def receivePending(websocket):
+    await websocket.send(f'{{"type": "pendingSend", "address": "{publicKeyStr}"}}')
+    response = await websocket.recv()
+    pendingSend = json.loads(response)
+
+    # Also covers the node being busy, the send will still be pending next time
+    if pendingSend["type"] != "pendingSend" or pendingSend["link"] == "":
+        return
+
+    if head is None:
+        blockType = "open"
+        previous = "0"*20
+
+    else:
+        blockType = "receive"
+        previous = head
+
+    link = pendingSend["link"]
+    blockID = str(random.randint(0, 99999999999999999999))
+    blockID = "0" * (20 - len(blockID)) + blockID
+    block = {"type": f"{blockType}", "id": blockID, "previous": f"{previous}", "address": f"{publicKeyStr}", "link": f"{link}", "balance": balance+pendingSend["sendAmount"]}
+    await submitBlock(websocket, block)
+
 
 async def loop(websocket):
     while True:
-        # Ok, so websockets don't link data at all. If this thread sends something while the main thread is doing something else, the main thread will get this response instead.
-        if not doBackgroundCheck:
-            await asyncio.sleep(5)
-            continue
-
-        await websocket.send(f'{{"type": "pendingSend", "address": "{publicKeyStr}"}}')
-        response = await websocket.recv()
-        pendingSend = json.loads(response)
-
-        if pendingSend["link"] == "":
-            await asyncio.sleep(5)
-            continue
-
-        await websocket.send(f'{{"type": "balance", "address": "{publicKeyStr}"}}')
-        resp = await websocket.recv()
-        resp = json.loads(resp)
-
-        if resp["type"] != "rejection":
-            balance = int(resp["balance"])
-
-        else:
-            balance = 0
-
-        if balance == 0:
-            blockType = "open"
-            previous = "0"*20
-
-        else:
-            blockType = "receive"
-            await websocket.send(f'{{"type": "getPrevious", "address": "{publicKeyStr}"}}')
-            response = await websocket.recv()
-            previous = json.loads(response)["link"]
-
-        link = pendingSend["link"]
-        blockID = str(random.randint(0, 99999999999999999999))
-        blockID = "0" * (20 - len(blockID)) + blockID
-        block = {"type": f"{blockType}", "id": blockID, "previous": f"{previous}", "address": f"{publicKeyStr}", "link": f"{link}", "balance": balance+pendingSend["sendAmount"]}
-        signature = await genSignature(block, privateKey)
-        block = {**block, **{"signature": signature}}
-
-        await websocket.send(json.dumps(block))
-        resp = await websocket.recv()
-        print(resp)
+        async with websocketLock:
+            # Don't sign anything on top of state we know is out of date, try again next round instead
+            if synced or await syncState(websocket):
+                await receivePending(websocket)
 
         await asyncio.sleep(5)
 
 async def main():
     uri = "ws://qwhwdauhdasht.ddns.net:6969"
     websocket = await websockets.connect(uri)
-    asyncio.create_task(loop(websocket))
-
-    global doBackgroundCheck
-    doBackgroundCheck = False
 
     await ping(websocket)
+    await syncState(websocket)
 
-    await websocket.send(f'{{"type": "balance", "address": "{publicKeyStr}"}}')
-    resp = await websocket.recv()
-    resp = json.loads(resp)
-
-    doBackgroundCheck = True
-
-    if resp["type"] != "rejection":
-        balance = int(resp["balance"])
-
-    else:
-        balance = 0
+    asyncio.create_task(loop(websocket))
 
     print(f"Balance: {balance}")
 
@@ -144,24 +177,24 @@ async def main():
         toSend = await ainput("Amount to send: ")
         toSend = int(toSend)
 
-        doBackgroundCheck = False
+        async with websocketLock:
+            if not synced and not await syncState(websocket):
+                print("Node is busy, try again later")
+                continue
 
-        newBalance = balance - toSend
-        blockID = str(random.randint(0, 99999999999999999999))
-        blockID = "0"*(20-len(blockID)) + blockID
+            # Sends have to build on an existing block, so the account has to receive something first
+            if head is None:
+                print("This account hasn't been opened yet, receive some MurraxCoin before sending")
+                continue
 
-        await websocket.send(f'{{"type": "getPrevious", "address": "{publicKeyStr}"}}')
-        response = await websocket.recv()
-        previous = json.loads(response)["link"]
+            newBalance = balance - toSend
+            blockID = str(random.randint(0, 99999999999999999999))
+            blockID = "0"*(20-len(blockID)) + blockID
 
-        data = {"type": "send", "address": f"{publicKeyStr}", "link": f"{sendAddress}", "balance": f"{newBalance}", "id": f"{blockID}", "previous": previous}
+            data = {"type": "send", "address": f"{publicKeyStr}", "link": f"{sendAddress}", "balance": f"{newBalance}", "id": f"{blockID}", "previous": head}
+            await submitBlock(websocket, data)
 
-        signature = await genSignature(data, privateKey)
-        data = {**data, **{"signature": f"{signature}"}}
-        await websocket.send(json.dumps(data))
-        resp = await websocket.recv()
-        print(resp)
-        doBackgroundCheck = True
+        print(f"Balance: {balance}")
 
 
 asyncio.get_event_loop().run_until_complete(main())